@@ -12,6 +12,7 @@ setup(
     license="MIT",
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
-    install_requires=["boto3", "diskcache", "fusepy", "requests", "slugid", "tenacity"],
+    install_requires=["boto3", "diskcache", "fusepy", "requests", "tenacity"],
+    extras_require={"aiohttp": ["aiohttp", "uvloop"], "httpx": ["httpx[http2]"]},
     version="0.4.12",
 )
@@ -31,10 +31,70 @@ def main():
 
     parser.add_argument("--disk-cache-dir", default="/tmp/xx")
 
+    parser.add_argument(
+        "--disk-cache-backend",
+        default="diskcache",
+        choices=["diskcache", "blockfile"],
+        help="Keep cached blocks in a diskcache database or in a file per url",
+    )
+
+    parser.add_argument(
+        "--disk-cache-eviction-policy",
+        default="least-recently-stored",
+        choices=[
+            "least-recently-stored",
+            "least-recently-used",
+            "least-frequently-used",
+        ],
+        help="The eviction policy of the diskcache disk cache backend",
+    )
+
     parser.add_argument("--lru-capacity", default=400, type=int)
 
+    parser.add_argument(
+        "--attr-ttl",
+        default=600,
+        type=int,
+        help="The number of seconds that file attributes are cached for",
+    )
+
+    parser.add_argument(
+        "--missing-attr-ttl",
+        default=60,
+        type=int,
+        help="The number of seconds that failed file lookups are cached for",
+    )
+
     parser.add_argument("--aws-profile", default=None, type=str)
 
+    parser.add_argument(
+        "--fetch-workers",
+        default=8,
+        type=int,
+        help="The number of block ranges to fetch concurrently",
+    )
+
+    parser.add_argument(
+        "--prefetch-blocks",
+        default=4,
+        type=int,
+        help="The number of blocks to read ahead when a file is read sequentially",
+    )
+
+    parser.add_argument(
+        "--http-backend",
+        default="requests",
+        choices=["requests", "httpx", "aiohttp"],
+        help="The library used for http(s) requests (httpx and aiohttp are optional)",
+    )
+
+    parser.add_argument(
+        "--multi-range",
+        action="store_true",
+        default=False,
+        help="Fetch separate block ranges of a read with one multi-range request",
+    )
+
     parser.add_argument(
         "--allow-other",
         action="store_true",
@@ -101,6 +161,14 @@ Mounting HTTP Filesystem...
             block_size=args["block_size"],
             aws_profile=args["aws_profile"],
             logger=logger,
+            fetch_workers=args["fetch_workers"],
+            http_backend=args["http_backend"],
+            prefetch_blocks=args["prefetch_blocks"],
+            disk_cache_backend=args["disk_cache_backend"],
+            multi_range=args["multi_range"],
+            disk_cache_eviction_policy=args["disk_cache_eviction_policy"],
+            attr_ttl=args["attr_ttl"],
+            missing_attr_ttl=args["missing_attr_ttl"],
         ),
         args["mountpoint"],
         foreground=args["foreground"],
@@ -1,15 +1,23 @@
+import asyncio
 import collections
+import contextlib
+import ctypes
+import ctypes.util
+import functools
+import hashlib
 import logging
 import os
 import os.path as op
 import re
+import struct
 import sys
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from errno import EIO, ENOENT
-from ftplib import FTP
+from ftplib import FTP, all_errors, error_temp
 from stat import S_IFDIR, S_IFREG
-from threading import Timer
-from time import sleep, time
+from time import time
 from urllib.parse import urlparse
 
 import boto3
@@ -17,6 +25,7 @@ import diskcache as dc
 import numpy as np
 import requests
 from fuse import FUSE, FuseOSError, LoggingMixIn, Operations
+from requests.adapters import HTTPAdapter
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -25,37 +34,89 @@ from tenacity import (
     wait_random,
 )
 
-import slugid
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
-CLEANUP_INTERVAL = 60
-CLEANUP_EXPIRED = 60
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
-REPORT_INTERVAL = 60
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# fallocate(2) frees the blocks evicted from the middle of a BlockFileCache
+# file. It's Linux only, elsewhere their space is only reused
+try:
+    _fallocate = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+except (AttributeError, OSError, TypeError):
+    _fallocate = None
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+# how long (in seconds) looked up file attributes and failed lookups are kept
+ATTR_TTL = 600
+MISSING_ATTR_TTL = 60
 
 DISK_CACHE_SIZE_ENV = "HTTPFS_DISK_CACHE_SIZE"
 DISK_CACHE_DIR_ENV = "HTTPFS_DISK_CACHE_DIR"
+DEBUG_ENV = "HTTPFS_DEBUG"
 
 
 FALSY = {0, "0", False, "false", "False", "FALSE", "off", "OFF"}
 
+# the most data that's fetched with a single range request
+MAX_RUN_SIZE = 2 ** 24
+# the least data in each of the pieces that a long run is split into
+MIN_SPLIT_SIZE = 2 ** 22
+
+DIR_ATTRS = dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
+
+# paths are files if they end with "..", anything else is a directory. SQLite
+# creates -journal and -wal files next to a database, which are always empty
+SQLITE_SUFFIXES = ("..-journal", "..-wal")
+FILE_SUFFIXES = ("..",) + SQLITE_SUFFIXES
+
 
 class LRUCache:
+    """
+    An approximate least recently used cache that is safe to share between
+    the threads that fusepy and the fetch pool run on.
+
+    Hits don't reorder entries, they only mark them as referenced, so reads
+    take no lock (single dict operations are atomic under the GIL). Only
+    inserts lock. When the cache is full, referenced entries at the old end
+    are given a second chance and moved to the new end instead of being
+    evicted (the CLOCK approximation of LRU).
+    """
+
+    __slots__ = ("capacity", "cache", "referenced", "lock")
+
     def __init__(self, capacity):
         self.capacity = capacity
         self.cache = collections.OrderedDict()
+        self.referenced = set()
+        self.lock = threading.Lock()
 
     def __getitem__(self, key):
-        value = self.cache.pop(key)
-        self.cache[key] = value
+        value = self.cache[key]
+        self.referenced.add(key)
         return value
 
     def __setitem__(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+        with self.lock:
+            if key in self.cache:
+                self.referenced.add(key)
+            else:
+                while len(self.cache) >= self.capacity:
+                    self.evict()
+            self.cache[key] = value
 
     def __contains__(self, key):
         return key in self.cache
@@ -63,59 +124,546 @@ class LRUCache:
     def __len__(self):
         return len(self.cache)
 
+    def update(self, items):
+        """
+        Insert a batch of (key, value) pairs under a single acquisition of
+        the lock, and only then evict whatever no longer fits.
+        """
+        with self.lock:
+            for key, value in items:
+                if key in self.cache:
+                    self.referenced.add(key)
+                self.cache[key] = value
+
+            while len(self.cache) > self.capacity:
+                self.evict()
+
+    def get(self, key, default=None, reference=True):
+        """
+        Return the value for key, or default if it isn't cached. Unlike a
+        membership test followed by a lookup, this can't race with another
+        thread evicting the key in between. With reference=False the hit
+        doesn't mark the entry as referenced.
+        """
+        try:
+            value = self.cache[key]
+        except KeyError:
+            return default
+        if reference:
+            self.referenced.add(key)
+        return value
+
+    def evict(self):
+        """Evict the oldest entry that wasn't referenced since its last pass."""
+        while True:
+            key, value = self.cache.popitem(last=False)
+            if key not in self.referenced:
+                return
+            self.referenced.discard(key)
+            self.cache[key] = value
+
+
+class SegmentedLRUCache(LRUCache):
+    """
+    A scan resistant LRUCache for blocks. New entries start out in a
+    probationary segment (self.cache) and only move to the protected
+    segment if they're referenced again before they reach its old end.
+    A long sequential read then cycles through the probationary segment
+    instead of evicting every block that's in regular use (segmented LRU).
+    """
+
+    __slots__ = ("protected", "protected_capacity")
+
+    PROTECTED_FRACTION = 0.8
+
+    def __init__(self, capacity):
+        super().__init__(capacity)
+        self.protected = collections.OrderedDict()
+        self.protected_capacity = int(capacity * self.PROTECTED_FRACTION)
+
+    def __getitem__(self, key):
+        try:
+            value = self.protected[key]
+        except KeyError:
+            value = self.cache[key]
+        self.referenced.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.update(((key, value),))
+
+    def __contains__(self, key):
+        return key in self.protected or key in self.cache
+
+    def __len__(self):
+        return len(self.cache) + len(self.protected)
+
+    def update(self, items):
+        with self.lock:
+            for key, value in items:
+                if key in self.protected:
+                    self.referenced.add(key)
+                    self.protected[key] = value
+                    continue
+                if key in self.cache:
+                    self.referenced.add(key)
+                self.cache[key] = value
+
+            while len(self) > self.capacity:
+                self.evict()
+
+    def get(self, key, default=None, reference=True):
+        try:
+            value = self.protected[key]
+        except KeyError:
+            try:
+                value = self.cache[key]
+            except KeyError:
+                return default
+        if reference:
+            self.referenced.add(key)
+        return value
+
+    def evict(self):
+        """
+        Evict the oldest probationary entry that wasn't referenced again,
+        promoting the ones that were to the protected segment.
+        """
+        while True:
+            key, value = self.cache.popitem(last=False)
+            if key not in self.referenced:
+                return
+            self.referenced.discard(key)
+            self.protected[key] = value
+
+            if len(self.protected) > self.protected_capacity:
+                self.demote()
+
+    def demote(self):
+        """Move the oldest unreferenced protected entry back to probation."""
+        while True:
+            key, value = self.protected.popitem(last=False)
+            if key not in self.referenced:
+                self.cache[key] = value
+                return
+            self.referenced.discard(key)
+            self.protected[key] = value
+
+
+class BlockFileCache:
+    """
+    A disk cache for fixed size blocks that keeps all the cached blocks of a
+    URL in one sparse file, with block N at offset N * block_size. Lookups
+    are a pread from the page cache rather than an sqlite query.
+
+    Keys are (url, block_size, block_num) tuples. Next to each data file is
+    an index file with the length of every cached block (stored as length
+    + 1 so that unwritten, zero filled entries mean "not cached"). When the
+    cached blocks add up to more than size_limit, the least recently written
+    blocks are evicted one by one, so a file that's bigger than the cache
+    keeps its latest blocks.
+    """
+
+    __slots__ = ("directory", "size_limit", "files", "blocks", "lock", "volume")
+
+    INDEX_ENTRY = struct.Struct("<I")
+    MAX_OPEN_FILES = 64
+
+    def __init__(self, directory, size_limit):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.files = collections.OrderedDict()
+        # (file_base, block_size, block_num) -> length, least recently
+        # written first
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.load_blocks()
+        self.volume = sum(self.blocks.values())
+
+    def load_blocks(self):
+        """
+        Find the blocks cached by an earlier run. Their write order isn't
+        recorded, so the blocks of older files are taken to be older.
+        """
+        entry_size = self.INDEX_ENTRY.size
+
+        for data_file in sorted(self.data_files(), key=op.getmtime):
+            base = data_file[: -len(".dat")]
+            block_size = int(base.rsplit(".", 1)[1])
+
+            try:
+                with open(base + ".idx", "rb") as f:
+                    index = f.read()
+            except FileNotFoundError:
+                continue
+
+            usable = len(index) - len(index) % entry_size
+            for block_num, (entry,) in enumerate(
+                self.INDEX_ENTRY.iter_unpack(index[:usable])
+            ):
+                if entry:
+                    self.blocks[(base, block_size, block_num)] = entry - 1
+
+    def file_base(self, url, block_size):
+        digest = hashlib.sha1(url.encode("utf8")).hexdigest()
+        return op.join(self.directory, "{}.{}".format(digest, block_size))
+
+    def open_files(self, url, block_size, create):
+        """
+        Return the (data, index) file descriptors for the blocks of a URL,
+        or None if nothing was cached for it and create is False.
+        """
+        files = self.files.get((url, block_size))
+        if files is not None:
+            self.files.move_to_end((url, block_size))
+            return files
+
+        base = self.file_base(url, block_size)
+        if not create and not op.exists(base + ".idx"):
+            return None
+
+        files = (
+            os.open(base + ".dat", os.O_RDWR | os.O_CREAT, 0o644),
+            os.open(base + ".idx", os.O_RDWR | os.O_CREAT, 0o644),
+        )
+        self.files[(url, block_size)] = files
+
+        if len(self.files) > self.MAX_OPEN_FILES:
+            for fd in self.files.popitem(last=False)[1]:
+                os.close(fd)
+
+        return files
+
+    def get(self, key, default=None):
+        url, block_size, block_num = key
+        entry_size = self.INDEX_ENTRY.size
+
+        with self.lock:
+            files = self.open_files(url, block_size, create=False)
+            if files is None:
+                return default
+
+            entry = os.pread(files[1], entry_size, block_num * entry_size)
+            if len(entry) < entry_size:
+                return default
+
+            length = self.INDEX_ENTRY.unpack(entry)[0] - 1
+            if length < 0:
+                return default
+
+            return os.pread(files[0], length, block_num * block_size)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        url, block_size, block_num = key
+        entry_size = self.INDEX_ENTRY.size
+
+        with self.lock:
+            data_fd, index_fd = self.open_files(url, block_size, create=True)
+            # write the data before the index entry that marks it as present
+            os.pwrite(data_fd, memoryview(value), block_num * block_size)
+            os.pwrite(
+                index_fd,
+                self.INDEX_ENTRY.pack(len(value) + 1),
+                block_num * entry_size,
+            )
+
+            block_key = (self.file_base(url, block_size), block_size, block_num)
+            self.volume += len(value) - self.blocks.pop(block_key, 0)
+            self.blocks[block_key] = len(value)
+            if self.volume > self.size_limit:
+                self.evict()
+
+    def data_files(self):
+        return [
+            op.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".dat")
+        ]
+
+    def remove_files(self, data_file):
+        base = data_file[: -len(".dat")]
+
+        for files_key in list(self.files):
+            if self.file_base(*files_key) == base:
+                for fd in self.files.pop(files_key):
+                    os.close(fd)
+
+        for filename in (data_file, base + ".idx"):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def remove_block(self, base, block_size, block_num):
+        """Mark a block as not cached and free its space."""
+        entry_size = self.INDEX_ENTRY.size
+
+        try:
+            data_fd = os.open(base + ".dat", os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            index_fd = os.open(base + ".idx", os.O_RDWR)
+            try:
+                os.pwrite(index_fd, self.INDEX_ENTRY.pack(0), block_num * entry_size)
+            finally:
+                os.close(index_fd)
+
+            if _fallocate is not None:
+                _fallocate(
+                    data_fd,
+                    FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                    block_num * block_size,
+                    block_size,
+                )
+        except FileNotFoundError:
+            pass
+        finally:
+            os.close(data_fd)
+
+    def evict(self):
+        """
+        Evict the least recently written blocks until we're under the limit,
+        but never the last one, which was written to be read right away.
+        """
+        while self.volume > self.size_limit and len(self.blocks) > 1:
+            block_key, length = self.blocks.popitem(last=False)
+            self.remove_block(*block_key)
+            self.volume -= length
+
+    @contextlib.contextmanager
+    def transact(self):
+        """
+        Hold the cache lock over a batch of operations, like diskcache's
+        Cache.transact(). There is no commit to amortize here, so this only
+        keeps other threads from interleaving with the batch.
+        """
+        with self.lock:
+            yield
+
+    def clear(self):
+        with self.lock:
+            for filename in self.data_files():
+                self.remove_files(filename)
+            self.blocks.clear()
+            self.volume = 0
+
+    def close(self):
+        with self.lock:
+            for files in self.files.values():
+                for fd in files:
+                    os.close(fd)
+            self.files.clear()
+
 
 class FtpFetcher:
+    """
+    Fetch data over ftp. Logged in connections are kept and reused, one
+    transfer at a time, rather than logging in again for every block.
+    """
+
+    TIMEOUT = 60
+
+    def __init__(self):
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
     def server_path(self, url):
         o = urlparse(url)
 
         return (o.netloc, o.path)
 
     def login(self, server):
-        ftp = FTP(server)
+        ftp = FTP(server, timeout=self.TIMEOUT)
         ftp.login()
+        # binary mode, which SIZE needs on most servers, for the whole session
+        ftp.voidcmd("TYPE I")
+
+        return ftp
+
+    @contextlib.contextmanager
+    def connection(self, server):
+        """
+        Check out a logged in connection to server, reusing an idle one if
+        it's still alive. Connections that fail are closed and not reused.
+        """
+        ftp = None
+        with self.lock:
+            if self.idle[server]:
+                ftp = self.idle[server].pop()
+
+        if ftp is not None:
+            try:
+                ftp.voidcmd("NOOP")
+            except all_errors:
+                ftp.close()
+                ftp = None
+
+        if ftp is None:
+            ftp = self.login(server)
 
         try:
-            # do a retrbinary on a non-existent file
-            # to set the transfer mode to binary
-            # use a dummy callback too
-            ftp.retrbinary(slugid.nice(), lambda x: x + 1)
-        except:
+            yield ftp
+        except BaseException:
+            ftp.close()
+            raise
+
+        with self.lock:
+            self.idle[server].append(ftp)
+
+    def end_transfer(self, ftp, conn):
+        """
+        Close a data connection, possibly before the whole file was sent,
+        and get the control connection back in step. Servers answer a
+        transfer that was cut short with 426 and/or 226, so after the first
+        of those skip responses until the reply to a NOOP.
+        """
+        conn.close()
+        try:
+            ftp.voidresp()
+        except error_temp:
             pass
 
-        return ftp
+        ftp.putcmd("NOOP")
+        while not ftp.getline().startswith("200"):
+            pass
 
     def get_size(self, url):
         (server, path) = self.server_path(url)
 
-        ftp = self.login(server)
-        size = ftp.size(path)
-        ftp.close()
-        return size
+        with self.connection(server) as ftp:
+            return ftp.size(path)
 
     def get_data(self, url, start, end):
-        import time
-
         (server, path) = self.server_path(url)
-        ftp = self.login(server)
-        conn = ftp.transfercmd("RETR {}".format(path), rest=start)
-
-        amt = end - start
-        chunk_size = 1 << 15
-        data = []
-        while len(data) < amt:
-            chunk = conn.recv(chunk_size)
-            if chunk:
-                data += chunk
-            else:
-                break
-        if len(data) < amt:
-            data += [0] * (amt - len(data))
+        with self.connection(server) as ftp:
+            conn = ftp.transfercmd("RETR {}".format(path), rest=start)
+
+            # end is inclusive, like in an http range
+            amt = end - start + 1
+            chunk_size = 1 << 15
+
+            # receive straight into the array that's returned
+            data = np.empty(amt, dtype=np.uint8)
+            view = memoryview(data)
+            received = 0
+            while received < amt:
+                read = conn.recv_into(view[received:], min(chunk_size, amt - received))
+                if not read:
+                    break
+                received += read
+            data[received:] = 0
+
+            self.end_transfer(ftp, conn)
+
+        return data
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for ftp in connections:
+                    ftp.close()
+            self.idle.clear()
+
+
+def consecutive_runs(block_nums, max_length=None):
+    """
+    Group a sorted list of block numbers into runs of consecutive
+    blocks, of at most max_length blocks each if it's given.
+
+    Returns a list of (first_block, last_block) tuples
+    """
+    runs = []
+
+    for block_num in block_nums:
+        if (
+            runs
+            and runs[-1][1] == block_num - 1
+            and (max_length is None or block_num - runs[-1][0] < max_length)
+        ):
+            runs[-1] = (runs[-1][0], block_num)
         else:
-            data = data[:amt]
+            runs.append((block_num, block_num))
+
+    return runs
+
+
+@functools.lru_cache(maxsize=4096)
+def path_url(schema, path):
+    """
+    Translate a mounted path (suffixed with "..") into the URL it stands for.
+
+    fusepy calls getattr and read with the same handful of paths over and
+    over, so the results are memoized. This also hands out the same string
+    object for a URL every time, whose hash is then only computed once.
+    """
+    return "{}:/{}".format(schema, path[:-2])
+
+
+def split_runs(runs, num_runs, min_length=1):
+    """
+    Split the longest of a list of (first_block, last_block) runs in half
+    until there are num_runs of them or they can't be split any further
+    without a half being shorter than min_length blocks.
+    """
+    runs = list(runs)
+
+    while 0 < len(runs) < num_runs:
+        longest = max(runs, key=lambda run: run[1] - run[0])
+        if longest[1] - longest[0] + 1 < 2 * min_length:
+            break
+
+        middle = (longest[0] + longest[1]) // 2
+        runs.remove(longest)
+        runs += [(longest[0], middle), (middle + 1, longest[1])]
 
-        ftp.close()
-        t2 = time.time()
-        return np.array(data, dtype=np.uint8)
+    return sorted(runs)
+
+
+def parse_byteranges(content_type, body):
+    """
+    Split the body of a multipart/byteranges response into its parts.
+
+    Returns a list of (start, data) tuples, one per part
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError("No boundary in {}".format(content_type))
+
+    delimiter = b"--" + match.group(1).encode("ascii")
+    view = memoryview(body)
+    parts = []
+
+    pos = body.find(delimiter)
+    while pos != -1:
+        pos += len(delimiter)
+        if body[pos : pos + 2] == b"--":
+            break
+
+        header_end = body.find(b"\r\n\r\n", pos)
+        headers = body[pos:header_end].decode("latin-1")
+        match = re.search(r"content-range:\s*bytes (\d+)-(\d+)", headers, re.I)
+        start, end = int(match.group(1)), int(match.group(2))
+
+        # take the part length from its Content-Range rather than searching
+        # the (binary) data for the next delimiter
+        data_start = header_end + 4
+        data_end = data_start + end - start + 1
+        parts.append((start, view[data_start:data_end]))
+        pos = body.find(delimiter, data_end)
+
+    return parts
 
 
 def is_403(value):
@@ -126,8 +674,15 @@ def is_403(value):
 class HttpFetcher:
     SSL_VERIFY = os.environ.get("SSL_VERIFY", True) not in FALSY
 
+    POOL_CONNECTIONS = 16
+    POOL_MAXSIZE = 64
+    # whether get_ranges sends one multi-range request
+    MULTI_RANGE = True
+
     def __init__(self, logger):
         self.logger = logger
+        self.open_session()
+
         if not self.SSL_VERIFY:
             logger.warning(
                 "You have set ssl certificates to not be verified. "
@@ -135,17 +690,23 @@ class HttpFetcher:
                 "http://docs.python-requests.org/en/master/user/advanced/#ssl-cert-verification"
             )
 
+    def open_session(self):
+        # share one session so that consecutive block requests reuse
+        # already established (keep-alive) connections
+        self.session = requests.Session()
+        self.session.verify = self.SSL_VERIFY
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_CONNECTIONS, pool_maxsize=self.POOL_MAXSIZE
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
     def get_size(self, url):
         try:
-            head = requests.head(url, allow_redirects=True, verify=self.SSL_VERIFY)
+            head = self.head(url)
             return int(head.headers["Content-Length"])
         except:
-            head = requests.get(
-                url,
-                allow_redirects=True,
-                verify=self.SSL_VERIFY,
-                headers={"Range": "bytes=0-1"},
-            )
+            head = self.get(url, headers={"Range": "bytes=0-1"})
             crange = head.headers["Content-Range"]
             match = re.search(r"/(\d+)$", crange)
             if match:
@@ -154,16 +715,250 @@ class HttpFetcher:
             self.logger.error(traceback.format_exc())
             raise FuseOSError(ENOENT)
 
+    def head(self, url):
+        return self.session.head(url, allow_redirects=True)
+
+    def get(self, url, headers):
+        return self.session.get(url, headers=headers, allow_redirects=True)
+
+    def stream(self, url, headers):
+        """
+        Send a GET request without reading its body, which is left to
+        read_body. The result is used as a context manager.
+        """
+        return self.session.get(url, headers=headers, allow_redirects=True, stream=True)
+
+    def read_body(self, response):
+        return response.content
+
     @retry(wait=wait_fixed(1) + wait_random(0, 2), stop=stop_after_attempt(2))
     def get_data(self, url, start, end):
-        headers = {"Range": "bytes={}-{}".format(start, end), "Accept-Encoding": ""}
+        headers = {
+            "Range": "bytes={}-{}".format(start, end),
+            "Accept-Encoding": "identity",
+        }
         self.logger.info("getting %s %s %s", url, start, end)
-        r = requests.get(url, headers=headers)
-        self.logger.info("got %s", r.status_code)
 
-        r.raise_for_status()
-        block_data = np.frombuffer(r.content, dtype=np.uint8)
-        return block_data
+        # read the body straight into the array that's returned rather than
+        # collecting it in a bytes object first
+        block_data = np.empty(end - start + 1, dtype=np.uint8)
+        view = memoryview(block_data)
+        size = 0
+        with self.session.get(
+            url, headers=headers, allow_redirects=True, stream=True
+        ) as r:
+            self.logger.info("got %s", r.status_code)
+            r.raise_for_status()
+
+            while size < len(view):
+                read = r.raw.readinto(view[size:])
+                if not read:
+                    break
+                size += read
+
+        return block_data[:size]
+
+    @retry(wait=wait_fixed(1) + wait_random(0, 2), stop=stop_after_attempt(2))
+    def get_ranges(self, url, ranges):
+        """
+        Fetch several (start, end) byte ranges of a URL with a single
+        multi-range request.
+
+        Servers that don't answer with the ranges (multipart/byteranges, or
+        one range covering them all) get a request per range instead.
+
+        Returns a list of data, one entry per range
+        """
+        headers = {
+            "Range": "bytes="
+            + ",".join("{}-{}".format(start, end) for start, end in ranges),
+            "Accept-Encoding": "identity",
+        }
+        self.logger.info("getting %s %s", url, headers["Range"])
+
+        # stream so that the body of a server ignoring the ranges, which
+        # would be the whole file, isn't downloaded
+        with self.stream(url, headers) as r:
+            self.logger.info("got %s", r.status_code)
+            r.raise_for_status()
+
+            parts = None
+            if r.status_code == 206:
+                content_type = r.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/byteranges"):
+                    parts = parse_byteranges(content_type, self.read_body(r))
+                else:
+                    # the server merged the ranges into one
+                    match = re.match(
+                        r"bytes (\d+)-", r.headers.get("Content-Range", "")
+                    )
+                    if match:
+                        parts = [(int(match.group(1)), memoryview(self.read_body(r)))]
+
+        result = []
+        for start, end in ranges:
+            for part_start, part_data in parts or ():
+                offset = start - part_start
+                # ranges running past the end of the file come back short
+                if 0 <= offset < len(part_data):
+                    part_data = part_data[offset : offset + end - start + 1]
+                    result.append(np.frombuffer(part_data, dtype=np.uint8))
+                    break
+            else:
+                # the server doesn't do multi-range requests (or has left
+                # this range out)
+                result.append(self.get_data(url, start, end))
+
+        return result
+
+    def close(self):
+        self.session.close()
+
+
+class HttpxFetcher(HttpFetcher):
+    """
+    Fetch data with httpx, which speaks HTTP/2 to servers that support it.
+    Concurrent range requests to a host, size lookups included, are then
+    multiplexed over a single connection instead of each needing a
+    connection of their own.
+    """
+
+    def __init__(self, logger):
+        if httpx is None:
+            raise ImportError("The httpx http backend requires httpx")
+
+        super().__init__(logger)
+
+    def open_session(self):
+        # the httpx client takes the place of the requests session, which
+        # would never be used
+        self.client = httpx.Client(
+            http2=True,
+            verify=self.SSL_VERIFY,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=self.POOL_MAXSIZE,
+                max_keepalive_connections=self.POOL_CONNECTIONS,
+            ),
+        )
+
+    def head(self, url):
+        return self.client.head(url)
+
+    def get(self, url, headers):
+        return self.client.get(url, headers=headers)
+
+    def stream(self, url, headers):
+        return self.client.stream("GET", url, headers=headers)
+
+    def read_body(self, response):
+        return response.read()
+
+    @retry(wait=wait_fixed(1) + wait_random(0, 2), stop=stop_after_attempt(2))
+    def get_data(self, url, start, end):
+        headers = {
+            "Range": "bytes={}-{}".format(start, end),
+            "Accept-Encoding": "identity",
+        }
+        self.logger.info("getting %s %s %s", url, start, end)
+
+        block_data = np.empty(end - start + 1, dtype=np.uint8)
+        view = memoryview(block_data)
+        size = 0
+        with self.client.stream("GET", url, headers=headers) as r:
+            self.logger.info("got %s", r.status_code)
+            r.raise_for_status()
+
+            # run the body to its end, an abandoned stream closes the
+            # connection instead of leaving it for the next request
+            for chunk in r.iter_raw():
+                chunk = chunk[: len(view) - size]
+                view[size : size + len(chunk)] = chunk
+                size += len(chunk)
+
+        return block_data[:size]
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncHttpFetcher(HttpFetcher):
+    """
+    Fetch data with aiohttp on an event loop that runs in a background
+    thread, so that many range requests can be in flight at once without
+    each of them holding a connection pool slot and a thread. The event
+    loop is a uvloop one if uvloop is installed.
+
+    File sizes are still looked up through the requests session of
+    HttpFetcher.
+    """
+
+    # get_ranges gathers a request per range instead
+    MULTI_RANGE = False
+
+    def __init__(self, logger):
+        if aiohttp is None:
+            raise ImportError("The aiohttp http backend requires aiohttp")
+
+        super().__init__(logger)
+
+        if uvloop is not None:
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self.run(self.create_client())
+
+    def run(self, coro):
+        """Run a coroutine on the fetcher's event loop and wait for it."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def create_client(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.POOL_MAXSIZE, ssl=None if self.SSL_VERIFY else False
+        )
+        return aiohttp.ClientSession(connector=connector, auto_decompress=False)
+
+    async def fetch(self, url, start, end):
+        headers = {
+            "Range": "bytes={}-{}".format(start, end),
+            "Accept-Encoding": "identity",
+        }
+        self.logger.info("getting %s %s %s", url, start, end)
+        async with self.client.get(url, headers=headers) as r:
+            self.logger.info("got %s", r.status)
+            r.raise_for_status()
+            content = await r.read()
+
+        return np.frombuffer(content, dtype=np.uint8)
+
+    async def fetch_ranges(self, url, ranges):
+        return await asyncio.gather(
+            *[self.fetch(url, start, end) for start, end in ranges]
+        )
+
+    @retry(wait=wait_fixed(1) + wait_random(0, 2), stop=stop_after_attempt(2))
+    def get_data(self, url, start, end):
+        return self.run(self.fetch(url, start, end))
+
+    @retry(wait=wait_fixed(1) + wait_random(0, 2), stop=stop_after_attempt(2))
+    def get_ranges(self, url, ranges):
+        """
+        Fetch several (start, end) byte ranges of a URL concurrently on the
+        event loop rather than tying up a fetch pool thread per range.
+
+        Returns a list of data, one entry per range
+        """
+        return self.run(self.fetch_ranges(url, ranges))
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        super().close()
 
 
 class S3Fetcher:
@@ -176,7 +971,12 @@ class S3Fetcher:
         self.client = self.session.client("s3")
         pass
 
-    def parse_bucket_key(self, url):
+    def close(self):
+        pass
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def parse_bucket_key(url):
         url_parts = urlparse(url, allow_fragments=False)
         bucket = url_parts.netloc
         key = url_parts.path.strip("/")
@@ -193,16 +993,36 @@ class S3Fetcher:
     @retry(wait=wait_exponential(multiplier=1, min=4, max=10))
     def get_data(self, url, start, end):
         bucket, key = self.parse_bucket_key(url)
-        obj = boto3.resource("s3").Object(bucket, key)
         stream = self.client.get_object(
             Bucket=bucket, Key=key, Range="bytes={}-{}".format(start, end)
         )["Body"]
-        contents = stream.read()
-        block_data = np.frombuffer(contents, dtype=np.uint8)
-        return block_data
 
+        if not hasattr(stream, "readinto"):
+            # botocore only has StreamingBody.readinto since 1.29
+            return np.frombuffer(stream.read(), dtype=np.uint8)
+
+        block_data = np.empty(end - start + 1, dtype=np.uint8)
+        view = memoryview(block_data)
+        size = 0
+        while size < len(view):
+            read = stream.readinto(view[size:])
+            if not read:
+                break
+            size += read
+        stream.close()
+
+        return block_data[:size]
 
-class HttpFs(LoggingMixIn, Operations):
+
+# fusepy's LoggingMixIn logs the repr of the arguments of every single
+# operation, so it's only mixed in when debugging
+if os.environ.get(DEBUG_ENV, False) not in FALSY:
+    HTTPFS_BASES = (LoggingMixIn, Operations)
+else:
+    HTTPFS_BASES = (Operations,)
+
+
+class HttpFs(*HTTPFS_BASES):
     """
     A read only http/https/ftp filesystem.
 
@@ -217,14 +1037,32 @@ class HttpFs(LoggingMixIn, Operations):
         block_size=2 ** 20,
         aws_profile=None,
         logger=None,
+        fetch_workers=8,
+        http_backend="requests",
+        prefetch_blocks=4,
+        disk_cache_backend="diskcache",
+        multi_range=False,
+        disk_cache_eviction_policy="least-recently-stored",
+        attr_ttl=ATTR_TTL,
+        missing_attr_ttl=MISSING_ATTR_TTL,
     ):
-        self.lru_cache = LRUCache(capacity=lru_capacity)
+        self.lru_cache = SegmentedLRUCache(capacity=lru_capacity)
         self.lru_attrs = LRUCache(capacity=lru_capacity)
+        self.attr_ttl = attr_ttl
+        self.missing_attr_ttl = missing_attr_ttl
         self.schema = schema
         self.logger = logger
-        self.last_report_time = 0
-        self.total_requests = 0
-        self.getting = set()
+        # block_id -> threading.Event for the blocks being fetched
+        self.fetching = {}
+        self.fetching_lock = threading.Lock()
+        self.fetch_workers = fetch_workers
+        self.pool = ThreadPoolExecutor(max_workers=fetch_workers)
+
+        # read ahead for files that are being read sequentially
+        self.prefetch_blocks = prefetch_blocks
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=fetch_workers)
+        # url -> where the last read of it ended
+        self.last_reads = LRUCache(capacity=lru_capacity)
 
         if not self.logger:
             self.logger = logging.getLogger(__name__)
@@ -232,7 +1070,14 @@ class HttpFs(LoggingMixIn, Operations):
         self.logger.info("Starting with disk_cache_size: %d", disk_cache_size)
 
         if schema == "http" or schema == "https":
-            self.fetcher = HttpFetcher(self.logger)
+            if http_backend == "requests":
+                self.fetcher = HttpFetcher(self.logger)
+            elif http_backend == "httpx":
+                self.fetcher = HttpxFetcher(self.logger)
+            elif http_backend == "aiohttp":
+                self.fetcher = AsyncHttpFetcher(self.logger)
+            else:
+                raise ValueError("Unknown http backend: {}".format(http_backend))
         elif schema == "ftp":
             self.fetcher = FtpFetcher()
         elif schema == "s3":
@@ -240,7 +1085,34 @@ class HttpFs(LoggingMixIn, Operations):
         else:
             raise ("Unknown schema: {}".format(schema))
 
-        self.disk_cache = dc.Cache(disk_cache_dir, size_limit=disk_cache_size)
+        self.multi_range = multi_range and getattr(self.fetcher, "MULTI_RANGE", False)
+        if multi_range and not self.multi_range:
+            self.logger.warning(
+                "Multi-range requests aren't supported for %s",
+                http_backend if schema in ("http", "https") else schema,
+            )
+
+        # the aiohttp event loop keeps any number of ranges in flight itself
+        self.gather_runs = isinstance(self.fetcher, AsyncHttpFetcher)
+
+        if disk_cache_backend == "diskcache":
+            self.disk_cache = dc.Cache(
+                disk_cache_dir,
+                size_limit=disk_cache_size,
+                eviction_policy=disk_cache_eviction_policy,
+            )
+        elif disk_cache_backend == "blockfile":
+            self.disk_cache = BlockFileCache(disk_cache_dir, size_limit=disk_cache_size)
+        else:
+            raise ValueError(
+                "Unknown disk cache backend: {}".format(disk_cache_backend)
+            )
+
+        self.disk_writer = ThreadPoolExecutor(max_workers=1)
+
+        # file sizes are kept on disk as well, so that remounting doesn't
+        # have to look them all up again
+        self.size_cache = dc.Cache(op.join(disk_cache_dir, "sizes"))
 
         self.total_blocks = 0
         self.lru_hits = 0
@@ -249,58 +1121,94 @@ class HttpFs(LoggingMixIn, Operations):
         self.disk_hits = 0
         self.disk_misses = 0
         self.block_size = block_size
+        self.max_run_blocks = max(MAX_RUN_SIZE // block_size, 1)
+        self.min_split_blocks = max(MIN_SPLIT_SIZE // block_size, 1)
+        # the usual power of two block sizes let us find blocks with shifts
+        if block_size & (block_size - 1) == 0:
+            self.block_shift = block_size.bit_length() - 1
+        else:
+            self.block_shift = None
 
     def getSize(self, url):
+        """
+        Look up the size of a URL, which is kept on disk for attr_ttl
+        seconds after it was fetched.
+
+        Returns the size and the time until which it's kept
+        """
+        size, expiry = self.size_cache.get(url, expire_time=True)
+        if size is not None:
+            return size, expiry
+
         try:
-            return self.fetcher.get_size(url)
+            size = self.fetcher.get_size(url)
         except Exception as ex:
             self.logger.exception(ex)
             raise
 
+        if size is not None:
+            self.disk_writer.submit(
+                self.size_cache.set, url, size, expire=self.attr_ttl
+            )
+        return size, time() + self.attr_ttl
+
     def getattr(self, path, fh=None):
-        try:
-            if path in self.lru_attrs:
-                return self.lru_attrs[path]
+        # cached entries are (expiry time, attrs, errno) where attrs is None
+        # if looking up the file failed
+        cached = self.lru_attrs.get(path)
+        if cached is not None and cached[0] > time():
+            (expiry, attrs, errno) = cached
+            if attrs is None:
+                raise FuseOSError(errno)
+            return attrs
 
-            if path == "/":
-                self.lru_attrs[path] = dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
-                return self.lru_attrs[path]
+        if path == "/":
+            return DIR_ATTRS
 
-            if (
-                path[-2:] != ".."
-                and not path.endswith("..-journal")
-                and not path.endswith("..-wal")
-            ):
-                return dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
+        if not path.endswith(FILE_SUFFIXES):
+            return DIR_ATTRS
 
-            url = "{}:/{}".format(self.schema, path[:-2])
+        try:
+            url = path_url(self.schema, path)
 
             # there's an exception for the -jounral files created by SQLite
-            if not path.endswith("..-journal") and not path.endswith("..-wal"):
-                size = self.getSize(url)
+            # the attributes expire with the size they're made from, so that
+            # rebuilding them from the disk cache doesn't extend its lifetime
+            if not path.endswith(SQLITE_SUFFIXES):
+                size, expiry = self.getSize(url)
             else:
-                size = 0
+                size, expiry = 0, time() + self.attr_ttl
 
             # logging.info("head: {}".format(head.headers))
             # logging.info("status_code: {}".format(head.status_code))
             # print("url:", url, "head.url", head.url)
 
+            now = time()
+
             if size is not None:
-                self.lru_attrs[path] = dict(
+                attrs = dict(
                     st_mode=(S_IFREG | 0o644),
                     st_nlink=1,
                     st_size=size,
-                    st_ctime=time(),
-                    st_mtime=time(),
-                    st_atime=time(),
+                    st_ctime=now,
+                    st_mtime=now,
+                    st_atime=now,
                 )
             else:
-                self.lru_attrs[path] = dict(st_mode=(S_IFDIR | 0o555), st_nlink=2)
+                attrs = DIR_ATTRS
 
-            return self.lru_attrs[path]
+            self.lru_attrs[path] = (expiry, attrs, None)
+            return attrs
         except Exception as ex:
             self.logger.exception(ex)
-            raise
+
+            # remember the failure for a little while so that repeated
+            # lookups of a missing file don't each go to the server
+            errno = ex.errno if isinstance(ex, FuseOSError) else EIO
+            self.lru_attrs[path] = (time() + self.missing_attr_ttl, None, errno)
+            # fusepy only passes on FuseOSError's errno, anything else
+            # (requests' errno-less ConnectionError included) is mangled
+            raise FuseOSError(errno)
 
     def unlink(self, path):
         return 0
@@ -312,124 +1220,354 @@ class HttpFs(LoggingMixIn, Operations):
         return 0
 
     def read(self, path, size, offset, fh):
-        t1 = time()
-
-        self.logger.debug("read %s %s %s", path, offset, size)
-
-        if t1 - self.last_report_time > REPORT_INTERVAL:
-            """
-            self.logger.info(
-                "lru hits: {} lru misses: {} disk hits: {} total_requests: {}".format(
-                    self.lru_hits,
-                    self.lru_misses,
-                    self.disk_hits,
-                    self.disk_misses,
-                    self.total_requests,
-                )
-            )
-            """
-            pass
         try:
-            self.total_requests += 1
-
             attr = self.getattr(path)
-            url = "{}:/{}".format(self.schema, path[:-2])
+            url = path_url(self.schema, path)
 
-            self.logger.debug("read url: {}".format(url))
-            self.logger.debug(
-                "offset: {} - {} request_size (KB): {:.2f} block: {}".format(
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("read %s %s %s", path, offset, size)
+                self.logger.debug("read url: %s", url)
+                self.logger.debug(
+                    "offset: %d - %d request_size (KB): %.2f block: %d",
                     offset,
                     offset + size - 1,
                     size / 2 ** 10,
                     offset // self.block_size,
                 )
-            )
-            output = np.zeros((size,), np.uint8)
-
-            t1 = time()
 
-            # nothing fetched yet
-            last_fetched = -1
-            curr_start = offset
+            block_size = self.block_size
+            end = offset + size
 
-            while last_fetched < offset + size:
-                block_num = curr_start // self.block_size
-                block_start = self.block_size * (curr_start // self.block_size)
-
-                block_id = (url, block_num)
-                while block_id in self.getting:
-                    sleep(0.05)
+            if self.block_shift is not None:
+                first_block = offset >> self.block_shift
+                last_block = (end - 1) >> self.block_shift
+            else:
+                first_block = offset // block_size
+                last_block = (end - 1) // block_size
+
+            # a read that starts where the last read of the file ended is
+            # part of the same stream. Its hits don't count as references,
+            # or reads smaller than a block would get every block of a long
+            # scan promoted. Rereading the same bytes does count
+            previous_end = self.last_reads.get(url)
+            streaming = offset == previous_end
+            self.last_reads[url] = end
+
+            blocks = self.get_blocks(
+                url, first_block, last_block, reference=not streaming
+            )
+            block_start = first_block * block_size
 
-                self.getting.add(block_id)
-                block_data = self.get_block(url, block_num)
-                self.getting.remove(block_id)
+            parts = []
+            for block_data in blocks:
+                data_start = max(offset - block_start, 0)
+                data_end = min(block_size, end - block_start)
+                data = memoryview(block_data)[data_start:data_end]
+                parts.append(data)
 
-                data_start = (
-                    curr_start - (curr_start // self.block_size) * self.block_size
-                )
+                if len(data) < data_end - data_start:
+                    # the block ends with the file
+                    parts.append(bytes(data_end - data_start - len(data)))
 
-                data_end = min(self.block_size, offset + size - block_start)
-                data = block_data[data_start:data_end]
+                block_start += block_size
 
-                d_start = curr_start - offset
-                output[d_start : d_start + len(data)] = data
+            # fusepy copies the result out with ctypes, which needs bytes.
+            # Joining views of the blocks makes that the only copy
+            result = b"".join(parts)
 
-                last_fetched = curr_start + (data_end - data_start)
-                curr_start += data_end - data_start
+            previous_block = None
+            if previous_end is not None:
+                previous_block = (previous_end - 1) // block_size
+            self.prefetch(url, previous_block, first_block, last_block, attr["st_size"])
 
-            bts = bytes(output)
-
-            return bts
+            return result
 
         except Exception as ex:
             self.logger.exception(ex)
             raise
 
     def destroy(self, path):
+        self.prefetch_pool.shutdown()
+        self.pool.shutdown()
+        self.fetcher.close()
+        self.disk_writer.shutdown()
         self.disk_cache.close()
+        self.size_cache.close()
 
-    def get_block(self, url, block_num):
-        """
-        Get a data block from a URL. Blocks are 256K bytes in size
+    def cache_key(self, url, block_num):
+        return (url, self.block_size, block_num)
 
-        Parameters:
-        -----------
-        url: string
-            The url of the file we want to retrieve a block from
-        block_num: int
-            The # of the 256K'th block of this file
+    def get_cached_block(self, url, block_num, reference=True):
         """
-        cache_key = "{}.{}.{}".format(url, self.block_size, block_num)
-        cache = self.disk_cache
+        Look a block up in the lru and disk caches. Returns None if
+        neither of them has it. With reference=False an lru cache hit
+        doesn't count towards keeping the block cached.
+        """
+        cache_key = self.cache_key(url, block_num)
 
         self.total_blocks += 1
 
-        if cache_key in self.lru_cache:
+        hit = self.lru_cache.get(cache_key, reference=reference)
+        if hit is not None:
             self.lru_hits += 1
-            hit = self.lru_cache[cache_key]
             return hit
         else:
             self.lru_misses += 1
 
-            if cache_key in self.disk_cache:
+            # a single lookup, which can't race with the disk cache evicting
+            # the block between a membership test and a read
+            block_data = self.disk_cache.get(cache_key)
+            if block_data is not None:
                 self.logger.info("cache hit: %s", cache_key)
-                try:
-                    block_data = self.disk_cache[cache_key]
-                    self.disk_hits += 1
-                    self.lru_cache[cache_key] = block_data
-                    return block_data
-                except KeyError:
-                    pass
+                self.disk_hits += 1
+                self.lru_cache[cache_key] = block_data
+                return block_data
 
             self.disk_misses += 1
-            block_start = block_num * self.block_size
 
-            self.logger.info("getting data %s", cache_key)
-            block_data = self.fetcher.get_data(
-                url, block_start, block_start + self.block_size - 1
-            )
+        return None
+
+    def fetch_blocks(self, url, first_block, last_block):
+        """
+        Fetch the consecutive blocks first_block..last_block of a URL with
+        a single range request and store them in the caches. The caller
+        claims the blocks (see claim_blocks) beforehand.
+
+        Returns a dictionary of block_num -> block_data
+        """
+        self.logger.info("getting data %s blocks %d-%d", url, first_block, last_block)
+        data = self.fetcher.get_data(
+            url,
+            first_block * self.block_size,
+            (last_block + 1) * self.block_size - 1,
+        )
+
+        blocks = self.split_blocks(
+            data, first_block, last_block, last_block > first_block
+        )
+
+        self.lru_cache.update(
+            (self.cache_key(url, block_num), block_data)
+            for block_num, block_data in blocks.items()
+        )
+
+        # the lru cache serves these blocks for now, so don't hold up
+        # the read while they're written to disk
+        self.disk_writer.submit(self.write_disk_blocks, url, blocks)
+
+        return blocks
+
+    def split_blocks(self, data, first_block, last_block, copy):
+        """
+        Split the data of the blocks first_block..last_block into blocks.
+        With copy, every block is copied out of data, so that a block in
+        the lru cache doesn't keep the whole buffer around.
+
+        Returns a dictionary of block_num -> block_data
+        """
+        blocks = {}
+        for i, block_num in enumerate(range(first_block, last_block + 1)):
+            block_data = data[i * self.block_size : (i + 1) * self.block_size]
+            blocks[block_num] = block_data.copy() if copy else block_data
+
+        return blocks
+
+    def fetch_runs(self, url, runs):
+        """
+        Fetch several (first_block, last_block) runs of blocks of a URL with
+        a single call to the fetcher's get_ranges (one multi-range request,
+        or concurrent requests on the aiohttp event loop) and store them in
+        the caches. The caller claims the blocks beforehand.
+
+        Returns a dictionary of block_num -> block_data
+        """
+        self.logger.info("getting data %s block runs %s", url, runs)
+        ranges = [
+            (first_block * self.block_size, (last_block + 1) * self.block_size - 1)
+            for first_block, last_block in runs
+        ]
+
+        blocks = {}
+        for (first_block, last_block), data in zip(
+            runs, self.fetcher.get_ranges(url, ranges)
+        ):
+            # the data of a multi-range response are all views of its body
+            blocks.update(self.split_blocks(data, first_block, last_block, True))
+
+        self.lru_cache.update(
+            (self.cache_key(url, block_num), block_data)
+            for block_num, block_data in blocks.items()
+        )
+
+        self.disk_writer.submit(self.write_disk_blocks, url, blocks)
+
+        return blocks
+
+    def write_disk_blocks(self, url, blocks):
+        # blocks are stored as bytes, which diskcache writes and reads back
+        # as they are, where numpy arrays would be pickled
+        try:
+            # one transaction (and so one sqlite commit) for the whole run
+            with self.disk_cache.transact():
+                for block_num, block_data in blocks.items():
+                    self.disk_cache[self.cache_key(url, block_num)] = bytes(block_data)
+        except Exception as ex:
+            self.logger.exception(ex)
 
-            self.lru_cache[cache_key] = block_data
-            self.disk_cache[cache_key] = block_data
+    def claim_blocks(self, url, block_nums):
+        """
+        Claim blocks of a URL for fetching, so that other reads wait for
+        them instead of fetching them too. Blocks that are already claimed
+        are left to whoever claimed them.
+
+        Returns a list of the claimed block numbers and a dictionary of
+        block_num -> threading.Event for the blocks that were claimed before
+        """
+        claimed = []
+        pending = {}
+
+        with self.fetching_lock:
+            for block_num in block_nums:
+                block_id = (url, block_num)
+                event = self.fetching.get(block_id)
+                if event is None:
+                    self.fetching[block_id] = threading.Event()
+                    claimed.append(block_num)
+                else:
+                    pending[block_num] = event
+
+        return claimed, pending
+
+    def release_blocks(self, url, block_nums):
+        """Release claimed blocks and wake up the reads waiting for them."""
+        with self.fetching_lock:
+            events = [self.fetching.pop((url, block_num)) for block_num in block_nums]
+
+        for event in events:
+            event.set()
+
+    def get_blocks(self, url, first_block, last_block, reference=True):
+        """
+        Get the consecutive blocks first_block..last_block of a URL. Every
+        run of blocks missing from the caches is retrieved with one request
+        rather than one request per block, and separate runs are retrieved
+        concurrently. Long runs are split up to make use of all the fetch
+        workers. Blocks that are already being fetched are waited for.
+        reference is passed on to get_cached_block.
+
+        Returns a list of block data, one entry per block
+        """
+        blocks = {}
+        needed = range(first_block, last_block + 1)
+        get_cached_block = self.get_cached_block
+
+        while needed:
+            missing = []
+            for block_num in needed:
+                block_data = get_cached_block(url, block_num, reference)
+
+                if block_data is None:
+                    missing.append(block_num)
+                else:
+                    blocks[block_num] = block_data
+
+            claimed, pending = self.claim_blocks(url, missing)
+            try:
+                blocks.update(self.fetch_missing(url, claimed))
+            finally:
+                self.release_blocks(url, claimed)
+
+            for event in pending.values():
+                event.wait()
+
+            # the blocks we waited for will normally be in the cache now,
+            # but if fetching them failed we'll claim them ourselves
+            needed = list(pending)
+
+        return [blocks[block_num] for block_num in range(first_block, last_block + 1)]
+
+    def fetch_missing(self, url, block_nums):
+        """
+        Fetch claimed blocks of a URL that are missing from the caches.
+
+        Returns a dictionary of block_num -> block_data
+        """
+        blocks = {}
+        runs = consecutive_runs(block_nums, self.max_run_blocks)
 
-        return block_data
+        if self.multi_range and len(runs) > 1:
+            # the holes between cached blocks all go in one request
+            blocks.update(self.fetch_runs(url, runs))
+        else:
+            # spread runs of several MiB over the pool too, so that a long
+            # cold read isn't limited to the throughput of one connection.
+            # Shorter runs stay a single request
+            runs = split_runs(runs, self.fetch_workers, self.min_split_blocks)
+
+            if len(runs) == 1:
+                blocks.update(self.fetch_blocks(url, *runs[0]))
+            elif self.gather_runs:
+                blocks.update(self.fetch_runs(url, runs))
+            else:
+                # runs are independent of each other so fetch them concurrently
+                futures = [
+                    self.pool.submit(self.fetch_blocks, url, *run) for run in runs
+                ]
+                for future in futures:
+                    blocks.update(future.result())
+
+        return blocks
+
+    def prefetch(self, url, previous_block, first_block, last_block, file_size):
+        """
+        Start fetching the prefetch_blocks blocks that follow a read in the
+        background, if the file is being read sequentially. previous_block
+        is the last block of the previous read of the file, if any.
+        """
+        if previous_block is None:
+            sequential = first_block == 0
+        else:
+            sequential = previous_block <= first_block <= previous_block + 1
+
+        # the window only moves on once a read reaches the next block
+        if not self.prefetch_blocks or not sequential or last_block == previous_block:
+            return
+
+        num_blocks = (file_size + self.block_size - 1) // self.block_size
+        block_nums = range(
+            last_block + 1, min(last_block + self.prefetch_blocks + 1, num_blocks)
+        )
+
+        if block_nums:
+            self.prefetch_pool.submit(self.prefetch_run, url, block_nums)
+
+    def prefetch_run(self, url, block_nums):
+        # the blocks are only claimed once a worker picks the job up, so
+        # that reads never wait for a prefetch that is still queued
+        missing = []
+        for block_num in block_nums:
+            cache_key = self.cache_key(url, block_num)
+            if cache_key not in self.lru_cache and cache_key not in self.disk_cache:
+                missing.append(block_num)
+
+        claimed, _ = self.claim_blocks(url, missing)
+        try:
+            for run_start, run_end in consecutive_runs(claimed, self.max_run_blocks):
+                self.fetch_blocks(url, run_start, run_end)
+        except Exception as ex:
+            self.logger.exception(ex)
+        finally:
+            self.release_blocks(url, claimed)
+
+    def get_block(self, url, block_num):
+        """
+        Get a data block from a URL. Blocks are block_size bytes in size
+
+        Parameters:
+        -----------
+        url: string
+            The url of the file we want to retrieve a block from
+        block_num: int
+            The # of the block_size'th block of this file
+        """
+        return self.get_blocks(url, block_num, block_num)[0]
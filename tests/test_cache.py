@@ -0,0 +1,168 @@
+import os
+
+from simple_httpfs.httpfs import (
+    BlockFileCache,
+    LRUCache,
+    SegmentedLRUCache,
+    consecutive_runs,
+    split_runs,
+)
+
+BLOCK_SIZE = 2 ** 16
+
+
+def test_block_file_cache_round_trip(tmp_path):
+    cache = BlockFileCache(str(tmp_path), 2 ** 30)
+    data = os.urandom(BLOCK_SIZE)
+
+    cache[("http://a", BLOCK_SIZE, 2)] = data
+
+    assert cache[("http://a", BLOCK_SIZE, 2)] == data
+    assert ("http://a", BLOCK_SIZE, 2) in cache
+    # blocks before and after the cached one, of another block size or url
+    assert cache.get(("http://a", BLOCK_SIZE, 1)) is None
+    assert cache.get(("http://a", BLOCK_SIZE, 3)) is None
+    assert cache.get(("http://a", 2 * BLOCK_SIZE, 2)) is None
+    assert cache.get(("http://b", BLOCK_SIZE, 2)) is None
+    cache.close()
+
+
+def test_block_file_cache_short_last_block(tmp_path):
+    cache = BlockFileCache(str(tmp_path), 2 ** 30)
+
+    cache[("http://a", BLOCK_SIZE, 0)] = bytes(BLOCK_SIZE)
+    cache[("http://a", BLOCK_SIZE, 1)] = b"end"
+
+    assert cache[("http://a", BLOCK_SIZE, 1)] == b"end"
+    assert cache[("http://a", BLOCK_SIZE, 0)] == bytes(BLOCK_SIZE)
+    cache.close()
+
+
+def test_block_file_cache_eviction(tmp_path):
+    cache = BlockFileCache(str(tmp_path), int(2.5 * BLOCK_SIZE))
+
+    for url in ["http://a", "http://b", "http://c"]:
+        cache[(url, BLOCK_SIZE, 0)] = os.urandom(BLOCK_SIZE)
+
+    assert ("http://a", BLOCK_SIZE, 0) not in cache
+    assert ("http://b", BLOCK_SIZE, 0) in cache
+    assert ("http://c", BLOCK_SIZE, 0) in cache
+    assert cache.volume <= cache.size_limit
+    cache.close()
+
+
+def test_block_file_cache_file_larger_than_limit(tmp_path):
+    cache = BlockFileCache(str(tmp_path), 4 * BLOCK_SIZE)
+
+    for block_num in range(10):
+        cache[("http://a", BLOCK_SIZE, block_num)] = os.urandom(BLOCK_SIZE)
+        assert ("http://a", BLOCK_SIZE, block_num) in cache
+
+    cached = [
+        block_num
+        for block_num in range(10)
+        if ("http://a", BLOCK_SIZE, block_num) in cache
+    ]
+    assert cached == [6, 7, 8, 9]
+    assert cache.volume <= cache.size_limit
+    cache.close()
+
+    # the evicted blocks stay evicted in the next run
+    cache = BlockFileCache(str(tmp_path), 4 * BLOCK_SIZE)
+    assert cache.volume == 4 * BLOCK_SIZE
+    assert ("http://a", BLOCK_SIZE, 5) not in cache
+    assert ("http://a", BLOCK_SIZE, 6) in cache
+    cache.close()
+
+
+def test_block_file_cache_reopen(tmp_path):
+    data = os.urandom(BLOCK_SIZE)
+    cache = BlockFileCache(str(tmp_path), 2 ** 30)
+    cache[("http://a", BLOCK_SIZE, 5)] = data
+    cache.close()
+
+    cache = BlockFileCache(str(tmp_path), 2 ** 30)
+
+    assert cache[("http://a", BLOCK_SIZE, 5)] == data
+    assert cache.volume >= BLOCK_SIZE
+    cache.clear()
+    assert ("http://a", BLOCK_SIZE, 5) not in cache
+    cache.close()
+
+
+def test_consecutive_runs():
+    assert consecutive_runs([]) == []
+    assert consecutive_runs([1, 2, 3, 5, 6, 9]) == [(1, 3), (5, 6), (9, 9)]
+    assert consecutive_runs([1, 2, 3, 5, 6, 9], max_length=2) == [
+        (1, 2),
+        (3, 3),
+        (5, 6),
+        (9, 9),
+    ]
+
+
+def test_split_runs():
+    assert split_runs([], 4) == []
+    assert split_runs([(0, 15)], 4) == [(0, 3), (4, 7), (8, 11), (12, 15)]
+    assert split_runs([(0, 1), (5, 5)], 4) == [(0, 0), (1, 1), (5, 5)]
+    # enough runs already
+    assert split_runs([(0, 15), (20, 21)], 2) == [(0, 15), (20, 21)]
+
+
+def test_split_runs_min_length():
+    assert split_runs([(0, 15)], 4, min_length=8) == [(0, 7), (8, 15)]
+    assert split_runs([(0, 15)], 4, min_length=16) == [(0, 15)]
+    assert split_runs([(0, 14)], 4, min_length=8) == [(0, 14)]
+
+
+def test_lru_cache_evicts_oldest():
+    cache = LRUCache(3)
+    for key in "abcd":
+        cache[key] = key
+
+    assert "a" not in cache
+    assert [key in cache for key in "bcd"] == [True, True, True]
+    assert len(cache) == 3
+
+
+def test_lru_cache_second_chance():
+    cache = LRUCache(3)
+    for key in "abc":
+        cache[key] = key
+
+    assert cache["a"] == "a"
+    cache.update([("d", "d")])
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.get("b", "default") == "default"
+
+
+def test_segmented_lru_cache_scan_resistance():
+    cache = SegmentedLRUCache(10)
+    hot = range(8)
+    for key in hot:
+        cache[key] = key
+    for key in hot:
+        assert cache.get(key) == key
+
+    # a scan of keys that are each seen once
+    for key in range(100, 200):
+        cache[key] = key
+
+    assert all(key in cache for key in hot)
+    assert len(cache) == 10
+
+
+def test_segmented_lru_cache_unreferenced_hits():
+    cache = SegmentedLRUCache(10)
+    for key in range(8):
+        cache[key] = key
+    for key in range(8):
+        assert cache.get(key, reference=False) == key
+
+    for key in range(100, 200):
+        cache[key] = key
+
+    assert not any(key in cache for key in range(8))
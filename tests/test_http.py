@@ -0,0 +1,137 @@
+import logging
+
+import numpy as np
+import pytest
+
+from simple_httpfs.httpfs import HttpFetcher, HttpxFetcher, parse_byteranges
+
+logger = logging.getLogger(__name__)
+
+DATA = bytes(range(256)) * 4
+
+
+def byteranges(boundary, ranges, size=len(DATA)):
+    body = b""
+    for start, end in ranges:
+        end = min(end, size - 1)
+        body += (
+            "--{}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Range: bytes {}-{}/{}\r\n\r\n".format(boundary, start, end, size)
+        ).encode("ascii")
+        body += DATA[start : end + 1] + b"\r\n"
+    return body + "--{}--\r\n".format(boundary).encode("ascii")
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "content_type",
+    [
+        "multipart/byteranges; boundary=3d6b6a416f9b5",
+        'multipart/byteranges; boundary="3d6b6a416f9b5"',
+    ],
+)
+def test_parse_byteranges(content_type):
+    body = byteranges("3d6b6a416f9b5", [(0, 9), (100, 199)])
+
+    parts = parse_byteranges(content_type, body)
+
+    assert [(start, bytes(data)) for start, data in parts] == [
+        (0, DATA[0:10]),
+        (100, DATA[100:200]),
+    ]
+
+
+def test_parse_byteranges_short_at_eof():
+    body = byteranges("b", [(0, 9), (1000, 1099)])
+
+    parts = parse_byteranges("multipart/byteranges; boundary=b", body)
+
+    assert [(start, bytes(data)) for start, data in parts] == [
+        (0, DATA[0:10]),
+        (1000, DATA[1000:]),
+    ]
+
+
+def test_parse_byteranges_no_boundary():
+    with pytest.raises(ValueError):
+        parse_byteranges("multipart/byteranges", b"")
+
+
+def test_get_ranges_merged():
+    fetcher = HttpFetcher(logger)
+    fetcher.stream = lambda url, headers: FakeResponse(
+        206, {"Content-Range": "bytes 0-29/1024"}, DATA[0:30]
+    )
+    fetcher.get_data = None
+
+    result = fetcher.get_ranges("http://example.com/file", [(0, 9), (20, 29)])
+
+    assert [bytes(data) for data in result] == [DATA[0:10], DATA[20:30]]
+    fetcher.close()
+
+
+def test_get_ranges_short_at_eof():
+    fetcher = HttpFetcher(logger)
+    fetcher.stream = lambda url, headers: FakeResponse(
+        206,
+        {"Content-Type": "multipart/byteranges; boundary=b"},
+        byteranges("b", [(0, 9), (1000, 1099)]),
+    )
+    fetcher.get_data = None
+
+    result = fetcher.get_ranges("http://example.com/file", [(0, 9), (1000, 1099)])
+
+    assert [bytes(data) for data in result] == [DATA[0:10], DATA[1000:]]
+    fetcher.close()
+
+
+def test_get_ranges_not_supported():
+    fetcher = HttpFetcher(logger)
+    fetcher.stream = lambda url, headers: FakeResponse(200, {}, DATA)
+    fetcher.get_data = lambda url, start, end: np.frombuffer(
+        DATA[start : end + 1], dtype=np.uint8
+    )
+
+    result = fetcher.get_ranges("http://example.com/file", [(0, 9), (20, 29)])
+
+    assert [bytes(data) for data in result] == [DATA[0:10], DATA[20:30]]
+    fetcher.close()
+
+
+def test_httpx_get_ranges_uses_client():
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+
+    def handler(request):
+        assert request.headers["Range"] == "bytes=0-9,100-199"
+        return httpx.Response(
+            206,
+            headers={"Content-Type": "multipart/byteranges; boundary=b"},
+            content=byteranges("b", [(0, 9), (100, 199)]),
+        )
+
+    fetcher = HttpxFetcher(logger)
+    fetcher.client.close()
+    fetcher.client = httpx.Client(transport=httpx.MockTransport(handler))
+    assert not hasattr(fetcher, "session")
+
+    result = fetcher.get_ranges("http://example.com/file", [(0, 9), (100, 199)])
+
+    assert [bytes(data) for data in result] == [DATA[0:10], DATA[100:200]]
+    fetcher.close()
@@ -0,0 +1,110 @@
+import time
+from errno import EIO, ENOENT
+
+import numpy as np
+import pytest
+import requests
+from fuse import FuseOSError
+
+from simple_httpfs import httpfs
+from simple_httpfs.httpfs import HttpFs
+
+BLOCK_SIZE = 2 ** 16
+FILE_BLOCKS = 500
+
+
+@pytest.fixture
+def fs(tmp_path):
+    fs = HttpFs(
+        "https",
+        disk_cache_dir=str(tmp_path),
+        lru_capacity=50,
+        block_size=BLOCK_SIZE,
+        prefetch_blocks=0,
+    )
+    fs.fetcher.get_size = lambda url: FILE_BLOCKS * BLOCK_SIZE
+    fs.fetcher.get_data = lambda url, start, end: np.zeros(end - start + 1, np.uint8)
+    yield fs
+    fs.destroy(None)
+
+
+def test_hot_blocks_survive_sub_block_scan(fs):
+    # every other block, so that no read continues the one before it
+    hot_blocks = range(0, 80, 2)
+    for _ in range(2):
+        for block_num in hot_blocks:
+            fs.read("/hot/file..", BLOCK_SIZE, block_num * BLOCK_SIZE, None)
+
+    read_size = BLOCK_SIZE // 8
+    for offset in range(0, FILE_BLOCKS * BLOCK_SIZE, read_size):
+        fs.read("/scan/file..", read_size, offset, None)
+
+    for block_num in hot_blocks:
+        assert fs.cache_key("https://hot/file", block_num) in fs.lru_cache
+
+
+def test_reread_block_survives_scan(fs):
+    # a header that's read over and over, each time from its start
+    for _ in range(20):
+        fs.read("/hot/file..", 2 ** 12, 0, None)
+
+    for offset in range(0, 200 * BLOCK_SIZE, BLOCK_SIZE):
+        fs.read("/scan/file..", BLOCK_SIZE, offset, None)
+
+    assert fs.cache_key("https://hot/file", 0) in fs.lru_cache
+
+
+@pytest.mark.parametrize(
+    "error", [requests.ConnectionError("refused"), FuseOSError(ENOENT)]
+)
+def test_getattr_errno(fs, error):
+    def get_size(url):
+        raise error
+
+    fs.fetcher.get_size = get_size
+    expected = error.errno if isinstance(error, FuseOSError) else EIO
+
+    # the first lookup and the cached failure give the same errno
+    for _ in range(2):
+        with pytest.raises(FuseOSError) as excinfo:
+            fs.getattr("/missing/file..")
+        assert excinfo.value.errno == expected
+
+
+@pytest.mark.parametrize(
+    "schema,http_backend,multi_range",
+    [
+        ("https", "requests", True),
+        ("https", "httpx", True),
+        ("https", "aiohttp", False),
+        ("ftp", "requests", False),
+    ],
+)
+def test_multi_range_support(tmp_path, schema, http_backend, multi_range):
+    if http_backend != "requests":
+        pytest.importorskip(http_backend)
+
+    fs = HttpFs(
+        schema,
+        disk_cache_dir=str(tmp_path),
+        http_backend=http_backend,
+        multi_range=True,
+    )
+
+    assert fs.multi_range == multi_range
+    fs.destroy(None)
+
+
+def test_attrs_expire_with_cached_size(fs, monkeypatch):
+    fs.getattr("/a/file..")
+    fs.disk_writer.submit(lambda: None).result()
+    expiry = fs.lru_attrs.get("/a/file..")[0]
+
+    # attributes rebuilt from the size on disk later on keep its expiry
+    later = time.time() + 100
+    monkeypatch.setattr(httpfs, "time", lambda: later)
+    fs.lru_attrs.cache.clear()
+    fs.fetcher.get_size = None
+
+    assert fs.getattr("/a/file..")["st_size"] == FILE_BLOCKS * BLOCK_SIZE
+    assert fs.lru_attrs.get("/a/file..")[0] == pytest.approx(expiry, abs=1)